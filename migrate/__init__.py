@@ -17,6 +17,14 @@ Writing a migration script using python (example):
 def main(db):
     db.execute("ALTER TABLE Users ADD COLUMN email")
 ```
+
+Use db.executemany instead of calling db.execute in a loop:
+
+```python
+def main(db):
+    rows = [("alice@example.com", 1), ("bob@example.com", 2)]
+    db.executemany("UPDATE Users SET email = ? WHERE id = ?", rows)
+```
 """
 
 from pathlib import Path
@@ -24,27 +32,56 @@ import sqlite3
 import typing as t
 
 from .checks import check
-from .runner import Runner
+from .exceptions import MigrateError
+from .runner import Runner, Tuning
 from .scripts import find_scripts
 
 
-def migrate(db: str, migrations: Path, version: t.Optional[int] = None) -> int:
+def migrate(db: t.Optional[str], migrations: Path,
+            version: t.Optional[int] = None,
+            tuning: t.Optional[Tuning] = None, *,
+            con: t.Optional[sqlite3.Connection] = None,
+            cache: bool = False) -> int:
+    # pylint: disable=too-many-arguments
     """Migrate to specified version.
 
     If version is None, migrate to latest version instead.
+    tuning maps PRAGMA names to values set on the connection before running
+    migrations. It replaces runner.DEFAULT_TUNING, which switches the
+    database to WAL mode permanently; pass tuning={} to opt out, or set a
+    PRAGMA to None to skip it.
+
+    Pass either db or con. If con is given, it's used instead of opening a new
+    connection, and it's left open afterwards. It must not have an open
+    transaction, and it's only tuned if tuning is given explicitly.
+
+    If cache is True, parsed scripts are cached in a .migrate-cache.json file
+    inside the migrations directory.
     """
-    scripts = find_scripts(migrations)
+    if (db is None) == (con is None):
+        raise MigrateError("pass either a database path or a connection")
+    if con is not None and con.in_transaction:
+        raise MigrateError("connection has an open transaction")
+
+    scripts = find_scripts(migrations, cache)
     up_scripts, down_scripts = check(scripts)
 
     if version is None:
         version = up_scripts[-1].file_version
-    runner = Runner(up_scripts, down_scripts)
 
-    con = sqlite3.connect(db)
-    result = runner.migrate(con, version)
-    con.close()
+    if con is not None:
+        runner = Runner(up_scripts, down_scripts,
+                        {} if tuning is None else tuning)
+        return runner.migrate(con, version)
 
-    return result
+    assert db is not None
+    runner = Runner(up_scripts, down_scripts, tuning)
+
+    con = sqlite3.connect(db)
+    try:
+        return runner.migrate(con, version)
+    finally:
+        con.close()
 
 
 __all__ = ["migrate"]
@@ -4,6 +4,7 @@ from argparse import ArgumentParser
 from pathlib import Path
 
 from . import migrate
+from .runner import DEFAULT_TUNING
 
 
 def main() -> None:
@@ -13,8 +14,14 @@ def main() -> None:
     cli.add_argument("migrations", type=Path, help="migrations directory")
     cli.add_argument("--version", type=int,
                      help="version to migrate to (default: latest version)")
+    cli.add_argument("--cache", action="store_true",
+                     help="cache parsed scripts in migrations directory")
+    cli.add_argument("--no-wal", action="store_true",
+                     help="don't switch database to WAL journal mode")
     args = cli.parse_args()
-    migrate(args.database, args.migrations, args.version)
+    tuning = {**DEFAULT_TUNING, "journal_mode": None} if args.no_wal else None
+    migrate(args.database, args.migrations, args.version, tuning,
+            cache=args.cache)
 
 
 if __name__ == "__main__":
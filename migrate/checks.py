@@ -1,5 +1,7 @@
 """Performs additional checks on migration scripts."""
 
+from itertools import zip_longest
+from operator import attrgetter
 import typing as t
 
 from .exceptions import MigrationScriptError
@@ -13,17 +15,25 @@ def check_not_empty(up_scripts: list[Script],
         raise MigrationScriptError("no migration scripts found")
 
 
+def find_duplicate(versions: list[int]) -> t.Optional[int]:
+    """Return first duplicate in list of versions, or None if there's none."""
+    if len(set(versions)) == len(versions):
+        return None
+    seen = set()
+    for version in versions:
+        if version in seen:
+            return version
+        seen.add(version)
+    return None
+
+
 def check_unique_file_versions(up_scripts: list[Script],
                                down_scripts: list[Script]) -> None:
     """Make sure there are no duplicate file versions."""
-    for i, s in enumerate(up_scripts[:-1]):
-        if s.file_version == up_scripts[i+1].file_version:
-            raise MigrationScriptError("duplicate file version:",
-                                       s.file_version)
-    for i, s in enumerate(down_scripts[:-1]):
-        if s.file_version == down_scripts[i+1].file_version:
-            raise MigrationScriptError("duplicate file version:",
-                                       s.file_version)
+    for scripts in (up_scripts, down_scripts):
+        duplicate = find_duplicate([s.file_version for s in scripts])
+        if duplicate is not None:
+            raise MigrationScriptError("duplicate file version:", duplicate)
 
 
 def check_matching_file_versions(up_scripts: list[Script],
@@ -32,9 +42,18 @@ def check_matching_file_versions(up_scripts: list[Script],
 
     Assumes both lists are sorted.
     """
-    for up, down in zip(up_scripts, down_scripts):
-        if up.file_version != down.file_version:
-            script = min(up, down, key=lambda s: s.file_version)
+    up_versions = [s.file_version for s in up_scripts]
+    down_versions = [s.file_version for s in down_scripts]
+    if up_versions == down_versions:
+        return
+
+    pairs = zip_longest(up_versions, down_versions)
+    for i, (up, down) in enumerate(pairs):
+        if up != down:
+            if down is None or (up is not None and up < down):
+                script = up_scripts[i]
+            else:
+                script = down_scripts[i]
             raise MigrationScriptError("missing up or down script:", script)
 
 
@@ -76,11 +95,13 @@ def check(scripts: t.Iterable[Script]) -> tuple[list[Script], list[Script]]:
     """
     up_scripts = []
     down_scripts = []
-    for script in sorted(scripts, key=lambda s: s.file_version):
+    for script in scripts:
         if script.direction == "up":
             up_scripts.append(script)
         else:
             down_scripts.append(script)
+    up_scripts.sort(key=attrgetter("file_version"))
+    down_scripts.sort(key=attrgetter("file_version"))
 
     checks = [
         check_not_empty,
@@ -8,6 +8,15 @@ from .scripts import Script
 
 Direction = t.Literal["down", "up"]
 MigrationTable = dict[tuple[int, Direction], Script]
+Tuning = dict[str, t.Optional[str]]
+
+DEFAULT_TUNING: Tuning = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": "5000",
+    "cache_size": "-65536",
+    "temp_store": "MEMORY",
+}
 
 
 def get_current_user_version(con: Connection) -> int:
@@ -17,11 +26,50 @@ def get_current_user_version(con: Connection) -> int:
     return t.cast(int, row.fetchone()[0])
 
 
+def tune(con: Connection, tuning: Tuning) -> None:
+    """Set PRAGMAs on sqlite3 connection before running migrations.
+
+    PRAGMAs set to None are skipped.
+    """
+    for key, value in tuning.items():
+        if value is not None:
+            con.execute(f"PRAGMA {key}={value}")
+
+
+def apply(con: Connection, script: Script, chained: bool) -> None:
+    """Apply migration script.
+
+    If chained, the script is run inside a savepoint of the current
+    transaction instead of in its own transaction.
+    """
+    if not chained:
+        script.apply(con)
+        return
+
+    con.execute("SAVEPOINT migration")
+    try:
+        script.execute(con)
+    except BaseException:
+        if con.in_transaction:
+            con.execute("ROLLBACK TO migration")
+            con.execute("RELEASE migration")
+        raise
+    con.execute("RELEASE migration")
+
+
 class Runner:
     """Runs migrations."""
-    def __init__(self, up_scripts: list[Script], down_scripts: list[Script]):
-        """Assumes up_scripts and down_scripts have been checked and sorted."""
+    def __init__(self, up_scripts: list[Script], down_scripts: list[Script],
+                 tuning: t.Optional[Tuning] = None):
+        """Assumes up_scripts and down_scripts have been checked and sorted.
+
+        tuning replaces DEFAULT_TUNING if given, so tuning={} leaves the
+        connection untouched. Note that journal_mode=WAL is stored in the
+        database file, so it persists after the connection is closed.
+        """
         self.table: MigrationTable = {}
+        self.tuning: Tuning = dict(DEFAULT_TUNING if tuning is None
+                                   else tuning)
 
         if up_scripts:
             self.table[(0, "up")] = up_scripts[0]
@@ -33,38 +81,97 @@ class Runner:
             for script in down_scripts:
                 self.table[(script.file_version, "down")] = script
 
-    def migrate_up(self, con: Connection, version: int) -> int:
-        """Migrate up to specified version."""
-        while True:
-            current_version = get_current_user_version(con)
-            if current_version >= version:
-                break
+    def plan(self, current_version: int, version: int) -> list[Script]:
+        """Return scripts to apply to migrate from current_version to version.
+
+        Stops before any script that would overshoot version.
+        """
+        scripts = []
+        while current_version < version:
             script = self.table[(current_version, "up")]
             if script.user_version > version:
                 break
-            script.apply(con)
-        return get_current_user_version(con)
-
-    def migrate_down(self, con: Connection, version: int) -> int:
-        """Migrate down to specificed version."""
-        while True:
-            current_version = get_current_user_version(con)
-            if current_version <= version:
-                break
+            scripts.append(script)
+            current_version = script.user_version
+        while current_version > version:
             script = self.table[(current_version, "down")]
             if script.user_version < version:
                 break
-            script.apply(con)
-        return get_current_user_version(con)
+            scripts.append(script)
+            current_version = script.user_version
+        return scripts
+
+    def run(self, con: Connection, scripts: list[Script],
+            chained: bool = True) -> int:
+        """Apply scripts in order and return resulting user_version.
+
+        If chained, all scripts are run in a single transaction, with a
+        savepoint for each script. If a script raises an Exception, only the
+        changes made by that script are rolled back. Other errors (e.g.
+        KeyboardInterrupt) roll back the whole transaction.
+        """
+        if not chained:
+            for script in scripts:
+                apply(con, script, chained)
+            return get_current_user_version(con)
+
+        con.commit()
+        con.execute("BEGIN TRANSACTION")
+        try:
+            for script in scripts:
+                apply(con, script, chained)
+            result = get_current_user_version(con)
+        except Exception:
+            # The failing script has been rolled back to its savepoint.
+            if con.in_transaction:
+                con.execute("COMMIT")
+            raise
+        except BaseException:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            raise
+        con.execute("COMMIT")
+        return result
+
+    def migrate_up(self, con: Connection, version: int,
+                   current_version: t.Optional[int] = None,
+                   chained: bool = True) -> int:
+        """Migrate up to specified version.
+
+        current_version is read from the database if not given.
+        """
+        if current_version is None:
+            current_version = get_current_user_version(con)
+        if current_version >= version:
+            return current_version
+        return self.run(con, self.plan(current_version, version), chained)
+
+    def migrate_down(self, con: Connection, version: int,
+                     current_version: t.Optional[int] = None,
+                     chained: bool = True) -> int:
+        """Migrate down to specificed version.
+
+        current_version is read from the database if not given.
+        """
+        if current_version is None:
+            current_version = get_current_user_version(con)
+        if current_version <= version:
+            return current_version
+        return self.run(con, self.plan(current_version, version), chained)
+
+    def migrate(self, con: Connection, version: int,
+                chained: bool = True) -> int:
+        """Migrate to specified version.
 
-    def migrate(self, con: Connection, version: int) -> int:
-        """Migrate to specified version."""
+        See run for what chained does.
+        """
+        tune(con, self.tuning)
         current_version = get_current_user_version(con)
         if current_version == version:
             return version
         if current_version < version:
-            return self.migrate_up(con, version)
-        return self.migrate_down(con, version)
+            return self.migrate_up(con, version, current_version, chained)
+        return self.migrate_down(con, version, current_version, chained)
 
 
 __all__ = ["Runner"]
@@ -1,12 +1,19 @@
 """Classes that represent migration scripts."""
 
 from abc import ABC, abstractmethod
+import ast
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from dataclasses import dataclass, field
 from importlib.util import module_from_spec, spec_from_file_location
-from locale import getpreferredencoding
+import json
+import os
 from pathlib import Path
 import re
-from sqlite3 import Connection
+from sqlite3 import Connection, complete_statement
+import sys
+from tempfile import NamedTemporaryFile
+from threading import Lock
 import typing as t
 
 from .exceptions import MigrationScriptError
@@ -14,8 +21,26 @@ from .exceptions import MigrationScriptError
 
 Direction = t.Literal["down", "up"]
 
+# Matches SQLite's default PRAGMA encoding.
+ENCODING = "utf-8"
 
-@dataclass(frozen=True)  # type: ignore
+# Minimum number of uncached scripts for loading them in a thread pool.
+PARALLEL_THRESHOLD = 8
+
+_IMPORT_LOCK = Lock()
+
+_FILENAME_RE = re.compile(r"^(\d+).*\.(up|down)(\.py|\.sql)$")
+_TRANSACTION_RE = re.compile(r"^begin\s+transaction\s*;(.*)commit\s*;$",
+                             re.IGNORECASE | re.DOTALL)
+_TRAILING_COMMENT_RE = re.compile(r";[ \t]*--[^\n]*$")
+_COMMENT_RE = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_PRAGMA_HEAD_RE = re.compile(r"^pragma\s+user_version\s*=\s*(\d+)\s*;",
+                             re.IGNORECASE | re.DOTALL)
+_PRAGMA_TAIL_RE = re.compile(r"pragma\s+user_version\s*=\s*(\d+)\s*;$",
+                             re.IGNORECASE | re.DOTALL)
+
+
+@dataclass(frozen=True, slots=True)  # type: ignore
 class Script(ABC):
     """Migration script."""
     path: Path
@@ -34,6 +59,13 @@ class Script(ABC):
         Note: applies script regardless of current database version.
         """
 
+    @abstractmethod
+    def execute(self, con: Connection) -> None:
+        """Execute migration script inside the current transaction.
+
+        Unlike apply, doesn't begin or commit a transaction.
+        """
+
 
 def import_python_script(name: str, path: Path) -> t.Any:
     """Import python script and return module."""
@@ -42,7 +74,9 @@ def import_python_script(name: str, path: Path) -> t.Any:
     assert spec
     module = module_from_spec(spec)
     assert spec.loader
-    spec.loader.exec_module(module)
+    # Scripts may be loaded from multiple threads (see find_scripts).
+    with _IMPORT_LOCK:
+        spec.loader.exec_module(module)
     return module
 
 
@@ -52,93 +86,198 @@ class SafeConnection:  # pylint: disable=too-few-public-methods
         self._con = con
         self.create_function = con.create_function
         self.execute = con.execute
+        self.executemany = con.executemany
 
 
 MigrationFunction = t.Callable[[SafeConnection], None]
 
 
-@dataclass(frozen=True)
+def parse_user_version(path: Path) -> t.Optional[int]:
+    """Get USER_VERSION from python script without running it.
+
+    Returns None unless USER_VERSION is assigned an integer literal exactly
+    once, at the top level of the script, and main is defined at the top
+    level, so that the script gets imported (and checked) instead.
+    """
+    tree = ast.parse(path.read_bytes(), str(path))
+    if not any(isinstance(node, ast.FunctionDef) and node.name == "main"
+               for node in tree.body):
+        return None
+
+    stores = [
+        node for node in ast.walk(tree)
+        if isinstance(node, ast.Name) and node.id == "USER_VERSION"
+        and isinstance(node.ctx, ast.Store)
+    ]
+    if len(stores) != 1:
+        return None
+
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and node.targets == stores:
+            value = getattr(node.value, "value", None)
+        elif isinstance(node, ast.AnnAssign) and node.target is stores[0]:
+            value = getattr(node.value, "value", None)
+        else:
+            continue
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        return None
+    return None
+
+
+def get_module_attribute(module: t.Any, name: str) -> t.Any:
+    """Get attribute of imported migration script."""
+    try:
+        return getattr(module, name)
+    except AttributeError as exc:
+        message = ("missing USER_VERSION" if name == "USER_VERSION"
+                   else f"missing '{name}' in .py script")
+        raise MigrationScriptError(message) from exc
+
+
+@dataclass(frozen=True, slots=True)
 class PythonScript(Script):
-    """Python migration scripts."""
-    main: MigrationFunction = field(init=False)
+    """Python migration scripts.
+
+    The script is only imported when it's applied, unless USER_VERSION and
+    main can't be found without running the script.
+    """
     _user_version: int = field(init=False)
+    _main: t.Optional[MigrationFunction] = field(
+        init=False, default=None, compare=False, repr=False,
+    )
 
     def __post_init__(self) -> None:
-        module = import_python_script("migration", self.path)
-
-        try:
-            user_version = getattr(module, "USER_VERSION")
-        except AttributeError as exc:
-            raise MigrationScriptError("missing USER_VERSION") from exc
-        try:
-            main = getattr(module, "main")
-        except AttributeError as exc:
-            raise MigrationScriptError("missing 'main' in .py script") from exc
-
+        user_version = parse_user_version(self.path)
+        if user_version is None:
+            module = import_python_script("migration", self.path)
+            user_version = get_module_attribute(module, "USER_VERSION")
+            object.__setattr__(self, "_main",
+                               get_module_attribute(module, "main"))
         object.__setattr__(self, "_user_version", user_version)
-        object.__setattr__(self, "main", main)
 
     @property
     def user_version(self) -> int:
         """Get user_version from module variable."""
         return self._user_version
 
+    @property
+    def main(self) -> MigrationFunction:
+        """Import script and return main function."""
+        if self._main is None:
+            module = import_python_script("migration", self.path)
+            object.__setattr__(self, "_main",
+                               get_module_attribute(module, "main"))
+        assert self._main is not None
+        return self._main
+
     def apply(self, con: Connection) -> None:
         """Apply Python script to sqlite3 database."""
         con.commit()
         con.execute("BEGIN TRANSACTION")
-        con.execute(f"PRAGMA user_version={self.user_version}")
-        self.main(SafeConnection(con))  # type: ignore
+        self.execute(con)
         con.execute("COMMIT")
 
+    def execute(self, con: Connection) -> None:
+        """Run Python script without transaction control."""
+        main = self.main
+        con.execute(f"PRAGMA user_version={self.user_version}")
+        main(SafeConnection(con))
+
 
 def remove_comments(sql: str) -> str:
     """Remove comments from SQL script."""
     # NOTE Does not strip multi-line comments.
+    if "--" not in sql:
+        return sql
     lines = map(str.strip, sql.split("\n"))
     return "\n".join(line for line in lines if not line.startswith("--"))
 
 
+def remove_outer_comments(sql: str) -> str:
+    """Remove comments before BEGIN and after COMMIT in SQL script."""
+    def is_comment(line: str) -> bool:
+        line = line.strip()
+        return not line or line.startswith("--")
+
+    lines = sql.strip().split("\n")
+    while lines and is_comment(lines[0]):
+        lines.pop(0)
+    while lines and is_comment(lines[-1]):
+        lines.pop()
+    if lines:
+        lines[-1] = _TRAILING_COMMENT_RE.sub(";", lines[-1].rstrip())
+    return "\n".join(lines)
+
+
 def unwrap_transaction(sql: str) -> str:
-    """Return block inside transaction."""
-    pattern = r"^begin\s+transaction\s*;(.*)commit\s*;$"
-    result = re.match(pattern, sql.strip(), re.IGNORECASE | re.DOTALL)
+    """Return block inside transaction.
+
+    Comments before BEGIN and after COMMIT are ignored.
+    """
+    result = _TRANSACTION_RE.match(remove_outer_comments(sql).strip())
     if not result:
         raise MigrationScriptError("SQL not wrapped in transaction")
     return result.groups()[0]
 
 
+def split_statements(block: str) -> list[str]:
+    """Split block of SQL into complete statements."""
+    statements = []
+    start = 0
+    end = block.find(";")
+    while end >= 0:
+        statement = block[start:end + 1]
+        if complete_statement(statement):
+            statements.append(statement.strip())
+            start = end + 1
+        end = block.find(";", end + 1)
+    rest = _COMMENT_RE.sub("", block[start:]).strip()
+    if rest:
+        raise MigrationScriptError("incomplete SQL statement:", rest)
+    return statements
+
+
 def parse_sql(sql: str) -> int:
     """Parse SQL script and return USER_VERSION.
 
     Raises error if the script is not wrapped in a transaction or if it does
     not set USER_VERSION.
     """
-    block = unwrap_transaction(remove_comments(sql)).strip()
-    pattern = r"pragma\s+user_version\s*=\s*(\d+)\s*;"
+    return parse_block(unwrap_transaction(remove_comments(sql)))
+
+
+def parse_block(block: str) -> int:
+    """Return USER_VERSION set in block inside transaction."""
+    block = block.strip()
 
     # NOTE Assume USER_VERSION is set in first or last line of transaction.
-    result = re.match(f"^{pattern}", block, re.IGNORECASE | re.DOTALL)
+    result = _PRAGMA_HEAD_RE.match(block)
     if result is not None:
         return int(result.groups()[0])
 
-    result = re.match(f"{pattern}$", block, re.IGNORECASE | re.DOTALL)
+    result = _PRAGMA_TAIL_RE.match(block)
     if result is not None:
         return int(result.groups()[0])
 
     raise MigrationScriptError("missing USER_VERSION")
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class SQLScript(Script):
     """SQL migration scripts."""
     text: str = field(init=False)
     _user_version: int = field(init=False)
 
     def __post_init__(self) -> None:
-        encoding = getpreferredencoding(False)
-        object.__setattr__(self, "text", self.path.read_text(encoding))
-        object.__setattr__(self, "_user_version", parse_sql(self.text))
+        text = self.path.read_text(ENCODING)
+        # Only keep the block inside the transaction. Comments are only
+        # removed for parsing USER_VERSION, because remove_comments doesn't
+        # preserve string literals.
+        block = unwrap_transaction(text)
+        object.__setattr__(self, "text", block)
+        object.__setattr__(self, "_user_version",
+                           parse_block(remove_comments(block)))
 
     @property
     def user_version(self) -> int:
@@ -146,21 +285,210 @@ class SQLScript(Script):
 
     def apply(self, con: Connection) -> None:
         """Apply SQL script to sqlite3 database."""
-        con.executescript(self.text)
+        con.commit()
+        con.execute("BEGIN TRANSACTION")
+        self.execute(con)
+        con.execute("COMMIT")
+
+    def execute(self, con: Connection) -> None:
+        """Run block inside transaction without transaction control.
+
+        Statements are executed one at a time, because executescript commits
+        the current transaction first.
+        """
+        for statement in split_statements(self.text):
+            con.execute(statement)
 
 
-def find_scripts(root: Path) -> t.Iterable[Script]:
-    """Find all migration scripts in root."""
-    pattern = re.compile(r"^(\d+).*\.(up|down)(\.py|\.sql)$")
-    for path in root.iterdir():
-        result = pattern.match(path.name)
-        if result:
+# Loaded scripts keyed by path, along with the mtime_ns and size they were
+# loaded from. Keeps one entry per path, so edited scripts replace old ones.
+_SCRIPT_CACHE: dict[Path, tuple[int, int, Script]] = {}
+
+
+def get_cached_script(path: Path, mtime_ns: int,
+                      size: int) -> t.Optional[Script]:
+    """Return loaded script if path hasn't changed since it was loaded."""
+    cached = _SCRIPT_CACHE.get(path)
+    if cached is not None and cached[:2] == (mtime_ns, size):
+        return cached[2]
+    return None
+
+
+def load_script(path: Path, mtime_ns: int, size: int, file_version: int,
+                direction: Direction) -> Script:
+    """Construct migration script.
+
+    Scripts are only reloaded when their mtime_ns or size changes.
+    """
+    script = get_cached_script(path, mtime_ns, size)
+    if script is None:
+        if path.suffix == ".py":
+            script = PythonScript(path, file_version, direction)
+        else:
+            script = SQLScript(path, file_version, direction)
+        _SCRIPT_CACHE[path] = (mtime_ns, size, script)
+    return script
+
+
+MANIFEST = ".migrate-cache.json"
+
+ManifestEntry = dict[str, t.Any]
+
+
+def load_manifest(root: Path) -> dict[str, ManifestEntry]:
+    """Load cached migration scripts info from root.
+
+    Returns an empty manifest if there's no valid cache.
+    """
+    try:
+        with open(root/MANIFEST, encoding=ENCODING) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def save_manifest(root: Path, manifest: dict[str, ManifestEntry]) -> None:
+    """Save migration scripts info in root.
+
+    The manifest is written to a temporary file first and then moved into
+    place, so concurrent runs never see a partial manifest.
+    Fails silently, e.g. if root is read-only.
+    """
+    try:
+        # pylint: disable-next=consider-using-with
+        file = NamedTemporaryFile("w", encoding=ENCODING, dir=root,
+                                  prefix=MANIFEST, delete=False)
+    except OSError:
+        return
+    try:
+        with file:
+            json.dump(manifest, file)
+        os.replace(file.name, root/MANIFEST)
+    except OSError:
+        with suppress(OSError):
+            os.unlink(file.name)
+
+
+def dump_script(script: Script, stat: os.stat_result) -> ManifestEntry:
+    """Return manifest entry for migration script."""
+    entry: ManifestEntry = {
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "user_version": script.user_version,
+    }
+    if isinstance(script, SQLScript):
+        entry["text"] = script.text
+    return entry
+
+
+def restore_script(path: Path, file_version: int, direction: Direction,
+                   entry: ManifestEntry) -> t.Optional[Script]:
+    """Construct migration script from manifest entry without parsing it.
+
+    Returns None if the entry is invalid.
+    """
+    cls: type[Script] = PythonScript if path.suffix == ".py" else SQLScript
+    fields = {
+        "path": path,
+        "file_version": file_version,
+        "direction": direction,
+        "_user_version": entry.get("user_version"),
+    }
+    if not isinstance(fields["_user_version"], int):
+        return None
+    if cls is SQLScript:
+        fields["text"] = entry.get("text")
+        if not isinstance(fields["text"], str):
+            return None
+    else:
+        fields["_main"] = None
+
+    script = cls.__new__(cls)
+    for name, value in fields.items():
+        object.__setattr__(script, name, value)
+    return script
+
+
+ScriptArgs = tuple[Path, int, int, int, Direction]
+ScannedScript = tuple[str, os.stat_result, t.Optional[Script]]
+
+
+def scan_scripts(
+    root: Path,
+    manifest: dict[str, ManifestEntry],
+) -> tuple[list[ScannedScript], list[ScriptArgs]]:
+    """Find migration scripts in root.
+
+    Returns scripts restored from the manifest (None if not cached), and
+    load_script arguments of scripts that still need to be loaded.
+    """
+    found: list[ScannedScript] = []
+    jobs: list[ScriptArgs] = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            result = _FILENAME_RE.match(entry.name)
+            if not result:
+                continue
             groups = result.groups()
-            args = (path, int(groups[0]), t.cast(Direction, groups[1]))
-            if groups[2] == ".py":
-                yield PythonScript(*args)
-            else:
-                yield SQLScript(*args)
+            args = (
+                Path(entry.path),
+                int(groups[0]),
+                t.cast(Direction, sys.intern(groups[1])),
+            )
+            stat = entry.stat()
+
+            script = None
+            cached = manifest.get(entry.name)
+            if (
+                isinstance(cached, dict)
+                and cached.get("mtime_ns") == stat.st_mtime_ns
+                and cached.get("size") == stat.st_size
+            ):
+                script = restore_script(*args, cached)
+            if script is None:
+                jobs.append((args[0], stat.st_mtime_ns, stat.st_size,
+                             args[1], args[2]))
+            found.append((entry.name, stat, script))
+    return found, jobs
+
+
+def load_scripts(jobs: list[ScriptArgs]) -> list[Script]:
+    """Load scripts, in parallel if enough of them aren't cached yet."""
+    scripts = [get_cached_script(*args[:3]) for args in jobs]
+    misses = [i for i, script in enumerate(scripts) if script is None]
+    if len(misses) < PARALLEL_THRESHOLD:
+        return [script or load_script(*args)
+                for script, args in zip(scripts, jobs)]
+
+    with ThreadPoolExecutor() as executor:
+        loaded = executor.map(lambda i: load_script(*jobs[i]), misses)
+        for i, script in zip(misses, loaded):
+            scripts[i] = script
+    return t.cast(list[Script], scripts)
+
+
+def find_scripts(root: Path, cache: bool = False) -> t.Iterable[Script]:
+    """Find all migration scripts in root.
+
+    If cache is True, script info is cached in root/MANIFEST, so that
+    unchanged scripts don't get parsed again in later runs.
+    """
+    manifest = load_manifest(root) if cache else {}
+    found, jobs = scan_scripts(root, manifest)
+    loaded = iter(load_scripts(jobs))
+
+    scripts = []
+    updated: dict[str, ManifestEntry] = {}
+    for name, stat, script in found:
+        if script is None:
+            script = next(loaded)
+        scripts.append(script)
+        updated[name] = dump_script(script, stat)
+
+    if cache and updated != manifest:
+        save_manifest(root, updated)
+    return scripts
 
 
 __all__ = ["Script", "PythonScript", "SQLScript", "find_scripts"]
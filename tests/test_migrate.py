@@ -1,12 +1,21 @@
 # pylint: disable=redefined-outer-name,no-self-use
 """Test migrate package."""
 
+import json
 from pathlib import Path
+import sqlite3
+import typing as t
 
 import pytest
 
 from migrate import migrate
-from migrate.exceptions import MigrationScriptError
+from migrate.exceptions import MigrateError, MigrationScriptError
+from migrate import scripts
+from migrate.checks import check
+from migrate.runner import DEFAULT_TUNING, Runner
+from migrate.scripts import (
+    find_scripts, get_cached_script, load_script, parse_user_version,
+)
 
 
 @pytest.fixture
@@ -79,6 +88,52 @@ def test_sql_not_in_transaction(database: Path, migrations: Path) -> None:
         migrate(str(database), migrations)
 
 
+def test_sql_trailing_comment(database: Path, migrations: Path) -> None:
+    """Comments after the last statement should be ignored."""
+    (migrations/"1_test.up.sql").write_text("""
+        BEGIN TRANSACTION;
+        PRAGMA user_version = 1;
+        CREATE TABLE Test (key);  -- note
+        COMMIT;
+    """)
+    (migrations/"1_test.down.sql").write_text(down(0))
+    assert migrate(str(database), migrations) == 1
+
+
+def test_sql_commit_in_trailing_comment(database: Path,
+                                        migrations: Path) -> None:
+    """COMMIT inside a comment after the transaction should be ignored."""
+    (migrations/"1_test.up.sql").write_text("""
+        -- begin transaction;
+        BEGIN TRANSACTION;
+        PRAGMA user_version = 1;
+        CREATE TABLE Test (key);
+        COMMIT;  -- done
+        -- remember to commit;
+    """)
+    (migrations/"1_test.down.sql").write_text(down(0))
+    assert migrate(str(database), migrations) == 1
+
+
+def test_sql_text_preserved(database: Path, migrations: Path) -> None:
+    """String literals shouldn't be changed by comment removal."""
+    value = "line1\n    indented\n-- not a comment\nend"
+    (migrations/"1_test.up.sql").write_text(f"""
+        -- Create test table.
+        BEGIN TRANSACTION;
+        PRAGMA user_version = 1;
+        CREATE TABLE Test (key);
+        INSERT INTO Test VALUES ('{value}');
+        COMMIT;
+    """)
+    (migrations/"1_test.down.sql").write_text(down(0))
+    assert migrate(str(database), migrations) == 1
+
+    con = sqlite3.connect(database)
+    assert con.execute("SELECT key FROM Test").fetchone()[0] == value
+    con.close()
+
+
 def test_with_mismatched_versions(database: Path, migrations: Path) -> None:
     """It should raise error."""
     (migrations/"1_test.up.sql").write_text(up(2))
@@ -104,3 +159,293 @@ def main(db):
 
     assert migrate(str(database), migrations, version=1) == 1
     assert migrate(str(database), migrations, version=0) == 0
+
+
+def test_python_script_executemany(database: Path,
+                                   migrations: Path) -> None:
+    """Python scripts should be able to use executemany."""
+    (migrations/"1_test.up.py").write_text("""
+USER_VERSION = 1
+
+def main(db):
+    db.execute("CREATE TABLE Test (key)")
+    db.executemany("INSERT INTO Test VALUES (?)", [(1,), (2,)])
+    """)
+    (migrations/"1_test.down.sql").write_text(down(0))
+    assert migrate(str(database), migrations) == 1
+
+    con = sqlite3.connect(database)
+    assert con.execute("SELECT key FROM Test").fetchall() == [(1,), (2,)]
+    con.close()
+
+
+def test_tuning(database: Path, migrations: Path) -> None:
+    """Connection should be tuned before running migrations."""
+    (migrations/"1_test.up.sql").write_text(up(1))
+    (migrations/"1_test.down.sql").write_text(down(0))
+
+    def journal_mode() -> str:
+        con = sqlite3.connect(database)
+        mode = con.execute("PRAGMA journal_mode").fetchone()[0]
+        con.close()
+        return t.cast(str, mode)
+
+    migrate(str(database), migrations, tuning={})
+    assert journal_mode() == "delete"
+
+    migrate(str(database), migrations, version=0)
+    assert journal_mode() == "wal"
+
+    migrate(str(database), migrations,
+            tuning={**DEFAULT_TUNING, "journal_mode": None})
+    assert journal_mode() == "wal"
+
+    migrate(str(database), migrations, version=0,
+            tuning={"journal_mode": "DELETE"})
+    assert journal_mode() == "delete"
+
+
+def test_chained_failure(database: Path, migrations: Path) -> None:
+    """Successful scripts before a failing script should be committed."""
+    (migrations/"1_test.up.sql").write_text(up(1))
+    (migrations/"1_test.down.sql").write_text(down(0))
+    (migrations/"2_test.up.py").write_text("""
+USER_VERSION = 2
+
+def main(db):
+    db.execute("CREATE TABLE Other (key)")
+    db.execute("CREATE TABLE Test (key)")
+    """)
+    (migrations/"2_test.down.sql").write_text(down(1))
+    with pytest.raises(sqlite3.OperationalError):
+        migrate(str(database), migrations)
+
+    con = sqlite3.connect(database)
+    assert con.execute("PRAGMA user_version").fetchone()[0] == 1
+    tables = con.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"
+    ).fetchall()
+    assert tables == [("Test",)]
+    con.close()
+
+
+def test_chained_interrupt(database: Path, migrations: Path) -> None:
+    """Interrupted migrations shouldn't be committed."""
+    (migrations/"1_test.up.py").write_text("""
+USER_VERSION = 1
+
+def main(db):
+    db.execute("CREATE TABLE Test (key)")
+    raise KeyboardInterrupt
+    """)
+    (migrations/"1_test.down.sql").write_text(down(0))
+    with pytest.raises(KeyboardInterrupt):
+        migrate(str(database), migrations)
+
+    con = sqlite3.connect(database)
+    assert con.execute("PRAGMA user_version").fetchone()[0] == 0
+    tables = con.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"
+    ).fetchall()
+    assert not tables
+    con.close()
+
+
+def test_shared_connection(database: Path, migrations: Path) -> None:
+    """Caller-provided connection should be reused and left open."""
+    (migrations/"1_test.up.sql").write_text(up(1))
+    (migrations/"1_test.down.sql").write_text(down(0))
+
+    con = sqlite3.connect(database)
+    con.execute("PRAGMA synchronous=FULL")
+    assert migrate(None, migrations, con=con) == 1
+    assert migrate(None, migrations, version=0, con=con) == 0
+    assert con.execute("PRAGMA user_version").fetchone()[0] == 0
+    assert con.execute("PRAGMA synchronous").fetchone()[0] == 2
+    assert con.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+
+    with pytest.raises(MigrateError):
+        migrate(str(database), migrations, con=con)
+
+    con.execute("CREATE TABLE Pending (key)")
+    con.execute("INSERT INTO Pending VALUES (1)")
+    assert con.in_transaction
+    with pytest.raises(MigrateError):
+        migrate(None, migrations, con=con)
+    con.close()
+
+
+def test_duplicate_file_version(database: Path, migrations: Path) -> None:
+    """File versions should be unique."""
+    (migrations/"1_test.up.sql").write_text(up(1))
+    (migrations/"1_test.down.sql").write_text(down(0))
+    (migrations/"1_other.up.sql").write_text(up(1))
+    (migrations/"1_other.down.sql").write_text(down(0))
+    with pytest.raises(MigrationScriptError):
+        migrate(str(database), migrations)
+
+
+def test_python_script_missing_main(database: Path,
+                                    migrations: Path) -> None:
+    """Python scripts without main should fail before migrating."""
+    (migrations/"1_test.up.sql").write_text(up(1))
+    (migrations/"1_test.down.sql").write_text(down(0))
+    (migrations/"2_test.up.py").write_text("USER_VERSION = 2\n")
+    (migrations/"2_test.down.sql").write_text(down(1))
+    with pytest.raises(MigrationScriptError):
+        migrate(str(database), migrations)
+
+    con = sqlite3.connect(database)
+    assert con.execute("PRAGMA user_version").fetchone()[0] == 0
+    con.close()
+
+
+def test_python_script_reassigned_version(database: Path,
+                                          migrations: Path) -> None:
+    """The last assignment to USER_VERSION should be used."""
+    (migrations/"1_test.up.py").write_text("""
+USER_VERSION = 0
+USER_VERSION = 1
+
+def main(db):
+    db.execute("CREATE TABLE Test (key)")
+    """)
+    (migrations/"1_test.down.sql").write_text(down(0))
+    assert migrate(str(database), migrations) == 1
+
+
+def test_python_script_bool_version(migrations: Path) -> None:
+    """Bools aren't valid USER_VERSION literals."""
+    path = migrations/"1_test.up.py"
+    path.write_text("USER_VERSION = True\n\ndef main(db):\n    pass\n")
+    assert parse_user_version(path) is None
+
+
+def test_python_script_not_imported(database: Path,
+                                    migrations: Path) -> None:
+    """Python scripts that aren't applied shouldn't be run."""
+    (migrations/"1_test.up.sql").write_text(up(1))
+    (migrations/"1_test.down.sql").write_text(down(0))
+    (migrations/"2_test.up.py").write_text("""
+raise RuntimeError
+
+USER_VERSION = 2
+
+def main(db):
+    pass
+    """)
+    (migrations/"2_test.down.sql").write_text(down(1))
+    assert migrate(str(database), migrations, version=1) == 1
+
+
+def test_missing_down_script(database: Path, migrations: Path) -> None:
+    """Each up script should have a down script."""
+    (migrations/"1_test.up.sql").write_text(up(1))
+    (migrations/"1_test.down.sql").write_text(down(0))
+    (migrations/"2_test.up.sql").write_text(up(2))
+    with pytest.raises(MigrationScriptError):
+        migrate(str(database), migrations)
+
+
+def test_manifest(database: Path, migrations: Path) -> None:
+    """Unchanged scripts should be loaded from the manifest."""
+    (migrations/"1_test.up.sql").write_text(up(1))
+    (migrations/"1_test.down.sql").write_text(down(0))
+    assert migrate(str(database), migrations, version=0) == 0
+    manifest_path = migrations/".migrate-cache.json"
+    assert not manifest_path.exists()
+
+    assert migrate(str(database), migrations, version=0, cache=True) == 0
+    assert not list(migrations.glob(".migrate-cache.json?*"))
+    manifest = json.loads(manifest_path.read_text())
+    assert manifest["1_test.up.sql"]["user_version"] == 1
+    manifest["1_test.up.sql"]["text"] = """
+        PRAGMA user_version = 1;
+        CREATE TABLE Cached (key);
+    """
+    manifest_path.write_text(json.dumps(manifest))
+
+    assert migrate(str(database), migrations, version=1, cache=True) == 1
+    con = sqlite3.connect(database)
+    tables = con.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"
+    ).fetchall()
+    assert tables == [("Cached",)]
+    con.close()
+
+
+def test_unchained(database: Path, migrations: Path) -> None:
+    """Scripts should also run in their own transactions."""
+    for version in (1, 2):
+        (migrations/f"{version}_test.up.sql").write_text(f"""
+            BEGIN TRANSACTION;
+            PRAGMA user_version = {version};
+            CREATE TABLE Test{version} (key);
+            COMMIT;
+        """)
+        (migrations/f"{version}_test.down.sql").write_text(f"""
+            BEGIN TRANSACTION;
+            PRAGMA user_version = {version - 1};
+            DROP TABLE Test{version};
+            COMMIT;
+        """)
+    runner = Runner(*check(find_scripts(migrations)), tuning={})
+
+    con = sqlite3.connect(database)
+    assert runner.migrate(con, 2, chained=False) == 2
+    assert runner.migrate(con, 0, chained=False) == 0
+    con.close()
+
+
+def test_script_cache(migrations: Path) -> None:
+    """Edited scripts should replace their old cache entry."""
+    path = migrations/"1_test.up.sql"
+    path.write_text(up(1))
+    stat = path.stat()
+    first = load_script(path, stat.st_mtime_ns, stat.st_size, 1, "up")
+    assert load_script(path, stat.st_mtime_ns, stat.st_size, 1, "up") is first
+
+    path.write_text(up(1) + "\n")
+    stat = path.stat()
+    second = load_script(path, stat.st_mtime_ns, stat.st_size, 1, "up")
+    assert second is not first
+    assert get_cached_script(path, stat.st_mtime_ns, stat.st_size) is second
+
+
+def test_manifest_write_failure(migrations: Path,
+                                monkeypatch: pytest.MonkeyPatch) -> None:
+    """Failed manifest writes shouldn't leave temporary files behind."""
+    (migrations/"1_test.up.sql").write_text(up(1))
+    (migrations/"1_test.down.sql").write_text(down(0))
+
+    def dump(*_: t.Any) -> None:
+        raise OSError
+
+    monkeypatch.setattr(json, "dump", dump)
+    find_scripts(migrations, cache=True)
+    assert not list(migrations.glob(".migrate-cache.json*"))
+
+
+def test_parallel_loading(database: Path, migrations: Path,
+                          monkeypatch: pytest.MonkeyPatch) -> None:
+    """Only uncached scripts should be loaded in a thread pool."""
+    for version in range(1, 6):
+        (migrations/f"{version}_test.up.sql").write_text(f"""
+            BEGIN TRANSACTION;
+            PRAGMA user_version = {version};
+            CREATE TABLE Test{version} (key);
+            COMMIT;
+        """)
+        (migrations/f"{version}_test.down.sql").write_text(f"""
+            BEGIN TRANSACTION;
+            PRAGMA user_version = {version - 1};
+            DROP TABLE Test{version};
+            COMMIT;
+        """)
+    assert migrate(str(database), migrations) == 5
+
+    def fail(*_: t.Any) -> None:
+        raise AssertionError("cached scripts shouldn't use thread pool")
+
+    monkeypatch.setattr(scripts, "ThreadPoolExecutor", fail)
+    assert migrate(str(database), migrations, version=0) == 0